@@ -6,7 +6,7 @@ from dataclasses import dataclass
 from typing import Sequence
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CliArgs:
     proto_files: list[str]
     build_dir: str = "tmp"
@@ -14,6 +14,7 @@ class CliArgs:
     include: list[str] = None
     grpc_endpoint: str = "dns:///localhost:50051"
     output_dir: str | None = None
+    verbose: bool = False
 
     @staticmethod
     def build_parser() -> argparse.ArgumentParser:
@@ -48,16 +49,19 @@ class CliArgs:
         p.add_argument(
             "--output-dir", default=None, help="Path to write the generated ini file."
         )
+        p.add_argument(
+            "-v",
+            "--verbose",
+            action="store_true",
+            help="Print executed commands and per-phase diagnostics",
+        )
         return p
 
     @classmethod
     def from_cli(cls, argv: Sequence[str] | None = None) -> "CliArgs":
-        ns = cls.build_parser().parse_args(argv)
-        return cls(
-            proto_files=list(ns.proto_files),
-            build_dir=ns.build_dir,
-            grpc_plugin=ns.grpc_plugin,
-            include=list(ns.include),
-            grpc_endpoint=ns.grpc_endpoint,
-            output_dir=ns.output_dir,
-        )
+        ns = _PARSER.parse_args(argv)
+        return cls(**vars(ns))
+
+
+# built once; reconstructing the ArgumentParser per from_cli call is wasted work
+_PARSER = CliArgs.build_parser()
@@ -1,12 +1,30 @@
 from pathlib import Path
+import logging
+import shutil
 import sys
 import os
 
 from args import CliArgs
 from validate import validate_includes, validate_proto_files
-from protoc import find_grpc_cpp_plugin, build_protoc_cmd, run_protoc
-from desc import load_fds, build_import_graph
+from protoc import (
+    find_grpc_cpp_plugin,
+    build_codegen_cmds,
+    build_descriptor_cmd,
+    build_protoc_cmd,
+    descriptor_name_for,
+    protoc_cache_key,
+    protoc_up_to_date,
+    publish_gen_tree,
+    run_protoc,
+    run_protoc_capture_fds,
+    run_protoc_many,
+    store_protoc_cache,
+    try_restore_protoc_cache,
+    write_depfile,
+)
+from desc import load_fds, load_fds_bytes, build_import_graph
 from compile_objects import build_objects_parallel
+from jobs import default_jobs
 from link_shared import build_shared_libs_layered_parallel
 from verify_links import verify_shared_libs
 from analyze_rpcs import dump_rpc_so_report
@@ -15,9 +33,15 @@ from gen_tpl import render_tpl_for_rpc_protos
 from common_static import compile_common_objects, archive_common_static
 from compile_tpl import compile_tpl_objects_parallel
 
+log = logging.getLogger(__name__)
+
 
 def run(argv=None):
     args = CliArgs.from_cli(argv)
+    logging.basicConfig(
+        format="%(message)s",
+        level=logging.DEBUG if args.verbose else logging.INFO,
+    )
 
     script_dir = Path(__file__).resolve().parent
     templates_dir = script_dir / "templates"
@@ -48,13 +72,84 @@ def run(argv=None):
     grpc_plugin = find_grpc_cpp_plugin(args.grpc_plugin)
 
     desc_pb = OUT / "all.desc.pb"
-    cmd = build_protoc_cmd(includes, proto_files, desc_pb, GEN, grpc_plugin)
-    run_protoc(cmd)
+    if protoc_up_to_date(
+        includes=includes, proto_files=proto_files, desc_pb=desc_pb, gen_dir=GEN
+    ):
+        log.info("# protoc: up to date")
+        fds = load_fds(desc_pb)
+    elif sys.platform != "win32":
+        dep_file = desc_pb.with_name(f"{desc_pb.name}.d")
+        desc_cmd = build_descriptor_cmd(includes, proto_files, Path("/dev/stdout"))
+        cache_key = protoc_cache_key(desc_cmd, proto_files, grpc_plugin, dep_file)
+        if try_restore_protoc_cache(cache_key, desc_pb=desc_pb, gen_dir=GEN):
+            log.info("# protoc: cache hit")
+            fds = load_fds(desc_pb)
+        else:
+            desc_bytes = run_protoc_capture_fds(desc_cmd)
+            # on-disk copy doubles as the --descriptor_set_in input below;
+            # published via os.replace so readers never see a torn file
+            desc_tmp = desc_pb.with_name(f"{desc_pb.name}.tmp.{os.getpid()}")
+            desc_tmp.write_bytes(desc_bytes)
+            os.replace(desc_tmp, desc_pb)
+            fds = load_fds_bytes(desc_bytes)
+            # protoc can't emit a dep file for a multi-proto run, so derive
+            # it from the descriptor set; the skip check and the cache key
+            # both read it on later runs
+            write_depfile(
+                dep_file,
+                fds=fds,
+                includes=includes,
+                proto_files=proto_files,
+                target=desc_pb,
+            )
+
+            # codegen wants descriptor-relative names, not filesystem paths;
+            # cpp and grpc write disjoint files and run concurrently. They
+            # write into a sibling temp dir that is atomically published on
+            # success, so a failed or killed run never leaves partial .pb.h
+            # files in GEN for downstream compiles to trip over.
+            names = {fd.name for fd in fds.file}
+            proto_names = [
+                # fall back to the path itself so a miss fails loudly in
+                # protoc instead of silently dropping the file
+                descriptor_name_for(p, includes, names) or os.fspath(p)
+                for p in proto_files
+            ]
+            gen_tmp = GEN.with_name(f"{GEN.name}.tmp.{os.getpid()}")
+            try:
+                run_protoc_many(
+                    build_codegen_cmds(desc_pb, proto_names, gen_tmp, grpc_plugin),
+                    jobs=2,
+                )
+            except BaseException:
+                shutil.rmtree(gen_tmp, ignore_errors=True)
+                raise
+            publish_gen_tree(gen_tmp, GEN)
+            # re-key off the fresh dep file: the pre-run key may have been
+            # None (no prior .d) or computed from an outdated input set
+            cache_key = protoc_cache_key(desc_cmd, proto_files, grpc_plugin, dep_file)
+            store_protoc_cache(cache_key, desc_pb=desc_pb, gen_dir=GEN)
+    else:
+        gen_tmp = GEN.with_name(f"{GEN.name}.tmp.{os.getpid()}")
+        cmd = build_protoc_cmd(includes, proto_files, desc_pb, gen_tmp, grpc_plugin)
+        try:
+            run_protoc(cmd)
+        except BaseException:
+            shutil.rmtree(gen_tmp, ignore_errors=True)
+            raise
+        publish_gen_tree(gen_tmp, GEN)
+        fds = load_fds(desc_pb)
+        write_depfile(
+            desc_pb.with_name(f"{desc_pb.name}.d"),
+            fds=fds,
+            includes=includes,
+            proto_files=proto_files,
+            target=desc_pb,
+        )
 
     include_dirs = [str(GEN)] + includes
-    jobs = int(os.environ.get("JOBS", "0")) or None
+    jobs = int(os.environ.get("JOBS", "0")) or default_jobs()
 
-    fds = load_fds(desc_pb)
     graph = build_import_graph(fds)
 
     render_tpl_for_rpc_protos(
@@ -78,7 +173,7 @@ def run(argv=None):
         include_dirs=tpl_include_dirs,
         jobs=jobs,
     )
-    print(f"# compiled tpl objects: {len(tpl_objs)}")
+    log.info(f"# compiled tpl objects: {len(tpl_objs)}")
     common_srcs = [
         tsurugi_udf_common_dir / "src" / "udf" / "descriptor_impl.cpp",
         tsurugi_udf_common_dir / "src" / "udf" / "error_info.cpp",
@@ -99,7 +194,7 @@ def run(argv=None):
         out_dir=CMN,
         name="libtsurugi_udf_common.a",
     )
-    print(f"# built common static: {common_a}")
+    log.info(f"# built common static: {common_a}")
 
     objs = build_objects_parallel(
         gen_dir=GEN,
@@ -107,7 +202,7 @@ def run(argv=None):
         include_dirs=include_dirs,
         jobs=jobs,
     )
-    print(f"# compiled objects: {len(objs)}")
+    log.info(f"# compiled objects: {len(objs)}")
 
     target_protos = set(graph.keys())
     exclude_protos = set()
@@ -122,7 +217,7 @@ def run(argv=None):
         tpl_objs_by_stem=tpl_objs_by_stem,
         common_static=common_a,
     )
-    print(f"# linked libs: {len(outputs)}")
+    log.info(f"# linked libs: {len(outputs)}")
 
     verify_shared_libs(
         outputs=outputs,
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import concurrent.futures
+import logging
 import os
 import shlex
 import subprocess
 from pathlib import Path
 
+from jobs import default_jobs
+
+log = logging.getLogger(__name__)
+
 
 def find_generated_cc(gen_dir: Path) -> list[Path]:
     cc: list[Path] = []
@@ -74,13 +79,13 @@ def build_objects_parallel(
 
     cc_files = find_generated_cc(gen_dir)
     if not cc_files:
-        print(f"no generated .cc files found under: {gen_dir}")
+        log.warning(f"no generated .cc files found under: {gen_dir}")
         return []
 
     objs = [obj_path_for(cc, gen_dir, obj_dir) for cc in cc_files]
 
-    max_workers = jobs or (os.cpu_count() or 4)
-    print(f"# compiling {len(cc_files)} files -> {obj_dir} (jobs={max_workers})")
+    max_workers = jobs or default_jobs()
+    log.debug(f"# compiling {len(cc_files)} files -> {obj_dir} (jobs={max_workers})")
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
         futs = [
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
 import concurrent.futures
+import logging
 import os
 import shlex
 import subprocess
 from pathlib import Path
 
+from jobs import default_jobs
+
+log = logging.getLogger(__name__)
+
 
 def _pkg_config_cflags() -> list[str]:
     try:
@@ -55,7 +60,7 @@ def compile_tpl_objects_parallel(
 
     cpp_files = sorted(tpl_dir.rglob("*.cpp"))
     if not cpp_files:
-        print(f"# no tpl cpp files under: {tpl_dir}")
+        log.warning(f"# no tpl cpp files under: {tpl_dir}")
         return [], {}
 
     def _obj_for(src: Path) -> Path:
@@ -64,8 +69,8 @@ def compile_tpl_objects_parallel(
 
     objs = [_obj_for(s) for s in cpp_files]
 
-    max_workers = jobs or (os.cpu_count() or 4)
-    print(
+    max_workers = jobs or default_jobs()
+    log.debug(
         f"# compiling tpl {len(cpp_files)} files -> {obj_dir / 'tpl'} (jobs={max_workers})"
     )
 
@@ -1,15 +1,53 @@
+import functools
+import mmap
+import os
+import sys
 from pathlib import Path
+
+# Pick the C-backed protobuf implementation (upb) unless the caller forced one.
+# Must be set before the first google.protobuf import anywhere in the process;
+# build.py imports this module before the other protobuf users.
+os.environ.setdefault("PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION", "upb")
+
 from google.protobuf.descriptor_pb2 import FileDescriptorSet
+from google.protobuf.internal import api_implementation
+
+if api_implementation.Type() == "python":
+    print(
+        "WARNING: pure-Python protobuf backend active; descriptor parsing "
+        "will be slow (install the upb/C++ backend)",
+        file=sys.stderr,
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _load_fds_cached(desc_pb: str, mtime_ns: int) -> FileDescriptorSet:
+    fds = FileDescriptorSet()
+    with open(desc_pb, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                fds.ParseFromString(memoryview(mm))
+        except (ValueError, TypeError):
+            # empty file (mmap refuses length 0) or a backend that only
+            # accepts bytes
+            fds.ParseFromString(f.read())
+    return fds
 
 
 def load_fds(desc_pb: Path) -> FileDescriptorSet:
+    return _load_fds_cached(str(desc_pb), desc_pb.stat().st_mtime_ns)
+
+
+def load_fds_bytes(data: bytes) -> FileDescriptorSet:
     fds = FileDescriptorSet()
-    fds.ParseFromString(desc_pb.read_bytes())
+    fds.ParseFromString(data)
     return fds
 
 
 def build_import_graph(fds):
-    g = {}
-    for fd in fds.file:
-        g[fd.name] = set(fd.dependency)
-    return g
+    # interned names make the downstream membership tests and dict lookups
+    # pointer comparisons; frozenset since nobody mutates the adjacency
+    return {
+        sys.intern(fd.name): frozenset(map(sys.intern, fd.dependency))
+        for fd in fds.file
+    }
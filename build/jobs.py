@@ -0,0 +1,11 @@
+from __future__ import annotations
+
+import os
+
+
+def default_jobs() -> int:
+    # affinity-aware: on cgroup/container-limited hosts cpu_count() overshoots
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
 import concurrent.futures
+import heapq
+import logging
 import os
 import shlex
 import subprocess
 from pathlib import Path
 from typing import Dict, Set, List, Tuple
 
+from jobs import default_jobs
+
+log = logging.getLogger(__name__)
+
 
 def _pkg_config_libs() -> list[str]:
     try:
@@ -34,32 +40,61 @@ def _dedup_keep_order(xs: list[str]) -> list[str]:
 
 
 def topo_layers(graph: Dict[str, Set[str]]) -> List[List[str]]:
-    nodes = set(graph.keys())
-    users: Dict[str, Set[str]] = {}
-    indeg: Dict[str, int] = {n: 0 for n in nodes}
-
+    # ids assigned in sorted-name order, so heap order on (depth, id) matches
+    # (depth, name) and layers stay deterministic.
+    names = sorted(graph)
+    id_of = {n: i for i, n in enumerate(names)}
+    n_nodes = len(names)
+
+    indeg = [0] * n_nodes
+    counts = [0] * n_nodes
     for n, deps in graph.items():
-        indeg[n] = len(deps)
+        indeg[id_of[n]] = len(deps)
         for d in deps:
-            users.setdefault(d, set()).add(n)
+            di = id_of.get(d)
+            if di is not None:
+                counts[di] += 1
+
+    # reverse-edge CSR: users_idx[users_ptr[d]:users_ptr[d+1]] are the ids of
+    # the nodes that depend on d.
+    users_ptr = [0] * (n_nodes + 1)
+    for i in range(n_nodes):
+        users_ptr[i + 1] = users_ptr[i] + counts[i]
+    users_idx = [0] * users_ptr[n_nodes]
+    fill = users_ptr[:n_nodes]
+    for n, deps in graph.items():
+        ni = id_of[n]
+        for d in deps:
+            di = id_of.get(d)
+            if di is None:
+                continue
+            users_idx[fill[di]] = ni
+            fill[di] += 1
+
+    # (depth, id) heap: popping by depth groups nodes into layers without a
+    # per-layer sort.
+    heap: list[tuple[int, int]] = [(0, i) for i in range(n_nodes) if indeg[i] == 0]
+    heapq.heapify(heap)
 
-    layer: list[str] = sorted([n for n in nodes if indeg[n] == 0])
     layers: List[List[str]] = []
     processed = 0
 
-    while layer:
-        layers.append(layer)
-        next_nodes: list[str] = []
-        for n in layer:
+    while heap:
+        depth = heap[0][0]
+        layer_ids: list[int] = []
+        while heap and heap[0][0] == depth:
+            layer_ids.append(heapq.heappop(heap)[1])
+        layers.append([names[i] for i in layer_ids])
+        for i in layer_ids:
             processed += 1
-            for u in users.get(n, ()):
+            for j in range(users_ptr[i], users_ptr[i + 1]):
+                u = users_idx[j]
                 indeg[u] -= 1
                 if indeg[u] == 0:
-                    next_nodes.append(u)
-        layer = sorted(next_nodes)
+                    heapq.heappush(heap, (depth + 1, u))
 
-    if processed != len(nodes):
-        remaining = sorted([n for n in nodes if indeg[n] > 0])
+    if processed != n_nodes:
+        remaining = sorted(names[i] for i in range(n_nodes) if indeg[i] > 0)
         raise RuntimeError(f"cycle detected in lib dependency graph: {remaining}")
 
     return layers
@@ -192,11 +227,11 @@ def build_shared_libs_layered_parallel(
     extra += _pkg_config_libs()
     extra = _dedup_keep_order(extra)
 
-    max_workers = jobs or (os.cpu_count() or 4)
+    max_workers = jobs or default_jobs()
     outputs: Dict[str, Path] = {}
 
     for i, layer in enumerate(layers):
-        print(f"# link layer[{i}] ({len(layer)} libs)")
+        log.debug(f"# link layer[{i}] ({len(layer)} libs)")
 
         def _job(pn: str) -> Tuple[str, Path]:
             out = lib_dir / proto_to_libfile[pn]
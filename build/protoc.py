@@ -1,63 +1,437 @@
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import re
+import shlex
 import shutil
+import stat
 import os
 from pathlib import Path
 import subprocess
-import sys
 
+from desc import load_fds
+from jobs import default_jobs
+
+log = logging.getLogger(__name__)
 
-def find_grpc_cpp_plugin(cli_value=None) -> Path:
-    candidates = []
-    if cli_value:
-        candidates.append(cli_value)
 
+def find_grpc_cpp_plugin(cli_value=None) -> Path:
+    # env vars are part of the cache key so a changed override is not served
+    # a stale result
     env_val = os.environ.get("GRPC_CPP_PLUGIN") or os.environ.get("PROTOC_GEN_GRPC")
-    if env_val:
-        candidates.append(env_val)
+    return _find_grpc_cpp_plugin_cached(cli_value, env_val)
 
-    which_val = shutil.which("grpc_cpp_plugin")
-    if which_val:
-        candidates.append(which_val)
 
-    candidates += ["/usr/bin/grpc_cpp_plugin", "/usr/local/bin/grpc_cpp_plugin"]
+@functools.lru_cache(maxsize=None)
+def _find_grpc_cpp_plugin_cached(cli_value, env_val) -> Path:
+    def candidates():
+        if cli_value:
+            yield cli_value
+        if env_val:
+            yield env_val
+        which_val = shutil.which("grpc_cpp_plugin")
+        if which_val:
+            yield which_val
+        yield "/usr/bin/grpc_cpp_plugin"
+        yield "/usr/local/bin/grpc_cpp_plugin"
 
     seen = set()
-    for c in candidates:
+    for c in candidates():
         if c in seen:
             continue
         seen.add(c)
-        p = Path(c)
-        if p.exists() and p.is_file() and os.access(str(p), os.X_OK):
-            return p
+        try:
+            st = os.stat(c)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and (st.st_mode & 0o111):
+            return Path(c)
 
     raise SystemExit("grpc_cpp_plugin not found")
 
 
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(p: str) -> None:
+    # memoized so repeated command builds don't re-stat/mkdir the same
+    # output dirs; keyed on str since Path isn't needed for makedirs
+    os.makedirs(p, exist_ok=True)
+
+
 def build_protoc_cmd(includes, proto_files, desc_out, gen_dir, grpc_plugin_path):
-    desc_out.parent.mkdir(parents=True, exist_ok=True)
-    gen_dir.mkdir(parents=True, exist_ok=True)
+    """Build one batched protoc command over all proto_files.
 
-    cmd = ["protoc"]
-    for inc in includes:
-        cmd.append(f"-I{inc}")
+    Pass the full file list in a single invocation: protoc startup (fork,
+    plugin load, well-known descriptor parsing) is fixed cost, so one call
+    over N files beats N calls. Split only when outputs must differ per file.
+    """
+    _ensure_dir(str(desc_out.parent))
+    # gen_dir is a fresh temp dir on this path too, so bypass the memo cache
+    os.makedirs(gen_dir, exist_ok=True)
+
+    # order-preserving dedup: repeated -I entries make protoc re-scan the
+    # same roots, and duplicate proto files can double-emit outputs
+    includes = dict.fromkeys(map(os.fspath, includes))
+    proto_files = dict.fromkeys(map(os.fspath, proto_files))
 
-    cmd += [
+    return [
+        "protoc",
+        *(f"-I{inc}" for inc in includes),
         "--include_imports",
         f"--descriptor_set_out={desc_out}",
         f"--cpp_out={gen_dir}",
         f"--grpc_out={gen_dir}",
         f"--plugin=protoc-gen-grpc={grpc_plugin_path}",
+        *map(str, proto_files),
     ]
-    cmd += [str(p) for p in proto_files]
-    return cmd
+
+
+def build_descriptor_cmd(includes, proto_files, desc_out):
+    """Parse the protos once into a self-contained descriptor set.
+
+    Codegen then reuses it via build_codegen_cmds/--descriptor_set_in, so
+    protoc pays the .proto parse (imports included) a single time. No
+    --dependency_out here: protoc rejects that flag with more than one
+    input file, so the driver synthesizes the dep file from the captured
+    descriptor set instead (write_depfile).
+    """
+    _ensure_dir(str(desc_out.parent))
+
+    includes = dict.fromkeys(map(os.fspath, includes))
+    proto_files = dict.fromkeys(map(os.fspath, proto_files))
+
+    return [
+        "protoc",
+        *(f"-I{inc}" for inc in includes),
+        "--include_imports",
+        f"--descriptor_set_out={desc_out}",
+        *proto_files,
+    ]
+
+
+def build_codegen_cmds(desc_in, proto_names, gen_dir, grpc_plugin_path):
+    """Two codegen commands (cpp backend, grpc plugin) off one descriptor set.
+
+    --descriptor_set_in skips the .proto parser entirely, so no -I flags are
+    needed; proto_names must be the file names recorded in the descriptor
+    set, not filesystem paths. The commands write disjoint files and are
+    safe for run_protoc_many.
+    """
+    # gen_dir here is usually a fresh temp dir, so bypass the memo cache
+    os.makedirs(gen_dir, exist_ok=True)
+
+    names = list(dict.fromkeys(proto_names))
+
+    cpp_cmd = [
+        "protoc",
+        f"--descriptor_set_in={desc_in}",
+        f"--cpp_out={gen_dir}",
+        *names,
+    ]
+    grpc_cmd = [
+        "protoc",
+        f"--descriptor_set_in={desc_in}",
+        f"--grpc_out={gen_dir}",
+        f"--plugin=protoc-gen-grpc={grpc_plugin_path}",
+        *names,
+    ]
+    return [cpp_cmd, grpc_cmd]
+
+
+def publish_gen_tree(tmp_dir: Path, gen_dir: Path) -> None:
+    """Move freshly generated files from tmp_dir into gen_dir.
+
+    os.replace is atomic on the same filesystem, so a concurrent compiler
+    reading gen_dir sees either the old file or the complete new one, never
+    a half-written .pb.h. tmp_dir is removed afterwards.
+    """
+    for src in tmp_dir.rglob("*"):
+        if src.is_file():
+            dst = gen_dir / src.relative_to(tmp_dir)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src, dst)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _resolve_proto(name: str, includes, proto_files) -> Path | None:
+    for p in proto_files:
+        if os.fspath(p).endswith(name):
+            return Path(p)
+    for inc in includes:
+        cand = Path(inc) / name
+        if cand.exists():
+            return cand
+    return None
+
+
+def descriptor_name_for(path, includes, names) -> str | None:
+    """Map a filesystem proto path to the name recorded in the descriptor
+    set. fd.name is the include-relative path, so strip the matching -I
+    root; a bare basename is only trusted when it matches exactly one
+    entry, since distinct protos may share a stem (cf. resolve_lib_names).
+    """
+    abs_p = os.path.abspath(os.fspath(path))
+    for inc in includes:
+        rel = os.path.relpath(abs_p, os.path.abspath(os.fspath(inc)))
+        if not rel.startswith(".."):
+            rel = rel.replace(os.sep, "/")
+            if rel in names:
+                return rel
+    base = Path(path).name
+    matches = [n for n in names if Path(n).name == base]
+    if len(matches) == 1:
+        return matches[0]
+    return None
+
+
+def _parse_depfile(dep_file: Path) -> list[str] | None:
+    """Read the Make-style dep file written by write_depfile and return the
+    dependency paths, or None if it is absent or malformed."""
+    try:
+        text = dep_file.read_text()
+    except OSError:
+        return None
+    text = text.replace("\\\n", " ")
+    # the target/deps separator is the first colon followed by whitespace;
+    # a bare partition(":") would split Windows drive letters like C:\
+    m = re.search(r":(?=\s|$)", text)
+    if m is None:
+        return None
+    deps = text[m.end() :]
+    # "\ " escapes spaces inside paths; protect them through the split
+    return [tok.replace("\0", " ") for tok in deps.replace("\\ ", "\0").split()]
+
+
+def write_depfile(dep_file: Path, *, fds, includes, proto_files, target) -> bool:
+    """Synthesize the Make-style dep file protoc's --dependency_out would
+    produce. protoc refuses that flag with more than one input file, but the
+    --include_imports descriptor set already names every transitive proto,
+    so resolve each entry against the include roots instead. Returns False
+    (removing any stale dep file, which disables the cache until the next
+    successful run) when an entry cannot be resolved."""
+    deps = []
+    for fd in fds.file:
+        src = _resolve_proto(fd.name, includes, proto_files)
+        if src is None:
+            dep_file.unlink(missing_ok=True)
+            return False
+        deps.append(os.fspath(src))
+    tmp = dep_file.with_name(f"{dep_file.name}.tmp.{os.getpid()}")
+    body = " \\\n ".join(d.replace(" ", "\\ ") for d in deps)
+    tmp.write_text(f"{os.fspath(target)}: {body}\n")
+    os.replace(tmp, dep_file)
+    return True
+
+
+def protoc_up_to_date(*, includes, proto_files, desc_pb: Path, gen_dir: Path) -> bool:
+    """Return True when the descriptor set and generated code are all newer
+    than every .proto input (transitive imports included), so the protoc run
+    can be skipped. Any unresolved import or missing output means False."""
+    if not desc_pb.exists():
+        return False
+    try:
+        fds = load_fds(desc_pb)
+    except Exception:
+        return False
+
+    newest_in = 0.0
+    deps = _parse_depfile(Path(f"{os.fspath(desc_pb)}.d"))
+    if deps is not None:
+        # protoc's own record of what it read: exact paths, no resolving
+        for d in deps:
+            try:
+                newest_in = max(newest_in, os.stat(d).st_mtime)
+            except OSError:
+                return False
+    else:
+        for fd in fds.file:
+            src = _resolve_proto(fd.name, includes, proto_files)
+            if src is None:
+                return False
+            newest_in = max(newest_in, src.stat().st_mtime)
+
+    # protoc only generates code for the explicitly listed protos
+    names = {fd.name for fd in fds.file}
+    oldest_out = desc_pb.stat().st_mtime
+    for p in proto_files:
+        name = descriptor_name_for(p, includes, names)
+        if name is None:
+            return False
+        base = gen_dir / Path(name).with_suffix("")
+        for suffix in (".pb.cc", ".pb.h", ".grpc.pb.cc", ".grpc.pb.h"):
+            out = Path(str(base) + suffix)
+            if not out.exists():
+                return False
+            oldest_out = min(oldest_out, out.stat().st_mtime)
+
+    return oldest_out > newest_in
+
+
+def _protoc_cache_root() -> Path | None:
+    if os.environ.get("PROTOC_CACHE", "1") == "0":
+        return None
+    env = os.environ.get("PROTOC_CACHE_DIR")
+    if env:
+        return Path(env)
+    return Path.home() / ".cache" / "protoc_gen"
+
+
+_CACHE_OUT_FLAGS = (
+    "--descriptor_set_out=",
+    "--cpp_out=",
+    "--grpc_out=",
+)
+
+
+def protoc_cache_key(cmd, proto_files, grpc_plugin_path, dep_file) -> str | None:
+    """Content-addressed key: the protoc command (minus output paths), the
+    bytes of every transitive input .proto, and the plugin binary's identity.
+
+    The listed protos alone are not enough — an edit to an import pulled in
+    via -I must change the key too, so the --dependency_out file (written by
+    the previous protoc run, cached alongside the outputs) supplies the full
+    input set. Returns None when that set is unknown or unreadable; callers
+    must treat None as "bypass the cache", never restoring or storing under
+    a key that does not cover every input.
+    """
+    deps = _parse_depfile(Path(dep_file))
+    if deps is None:
+        log.debug(f"# protoc cache bypassed: no usable dep file at {dep_file}")
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    for arg in cmd:
+        a = os.fspath(arg) if isinstance(arg, Path) else str(arg)
+        if a.startswith(_CACHE_OUT_FLAGS):
+            continue
+        h.update(a.encode())
+        h.update(b"\0")
+    inputs = set(map(os.fspath, proto_files))
+    inputs.update(deps)
+    for p in sorted(inputs):
+        h.update(p.encode())
+        try:
+            h.update(Path(p).read_bytes())
+        except OSError:
+            log.debug(f"# protoc cache bypassed: unreadable input {p}")
+            return None
+    try:
+        st = os.stat(grpc_plugin_path)
+        h.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+    except OSError:
+        pass
+    return h.hexdigest()
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def try_restore_protoc_cache(key: str | None, *, desc_pb: Path, gen_dir: Path) -> bool:
+    root = _protoc_cache_root()
+    if key is None or root is None:
+        return False
+    entry = root / key
+    cached_desc = entry / "desc.pb"
+    if not cached_desc.exists():
+        return False
+    for src in (entry / "gen").rglob("*"):
+        if src.is_file():
+            _link_or_copy(src, gen_dir / src.relative_to(entry / "gen"))
+    _link_or_copy(cached_desc, desc_pb)
+    # the dep file rides along so later runs can key on transitive inputs
+    cached_dep = entry / "desc.pb.d"
+    if cached_dep.exists():
+        _link_or_copy(cached_dep, desc_pb.with_name(f"{desc_pb.name}.d"))
+    return True
+
+
+def store_protoc_cache(key: str | None, *, desc_pb: Path, gen_dir: Path) -> None:
+    root = _protoc_cache_root()
+    if key is None or root is None:
+        return
+    entry = root / key
+    if (entry / "desc.pb").exists():
+        return
+    tmp = root / f"{key}.tmp.{os.getpid()}"
+    try:
+        for src in gen_dir.rglob("*"):
+            if src.is_file():
+                _link_or_copy(src, tmp / "gen" / src.relative_to(gen_dir))
+        _link_or_copy(desc_pb, tmp / "desc.pb")
+        dep_file = desc_pb.with_name(f"{desc_pb.name}.d")
+        if dep_file.exists():
+            _link_or_copy(dep_file, tmp / "desc.pb.d")
+        os.rename(tmp, entry)
+    except OSError:
+        # lost a publish race or an unwritable cache dir; never fail the build
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _echo_cmd(cmd):
+    # the join over a long argv is not free, so only render it when the
+    # debug level is actually on; shlex.join keeps the echo re-executable
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(shlex.join(map(os.fspath, cmd)))
 
 
 def run_protoc(cmd):
-    print(" ".join(map(str, cmd)))
+    _echo_cmd(cmd)
+    try:
+        # stderr inherits our fd: diagnostics stream as protoc emits them
+        # instead of being buffered in memory until exit.
+        # close_fds=False keeps CPython on its posix_spawn/vfork fast path
+        # (no fork of our page tables); adding preexec_fn, cwd or an fd
+        # scan would silently fall back to the slow fork+exec
+        subprocess.run(cmd, check=True, close_fds=False)
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(e.returncode)
+
+
+def run_protoc_many(cmds, jobs=None):
+    """Run independent protoc commands concurrently.
+
+    Callers must ensure the commands do not write the same outputs. Python
+    only waits on the subprocesses, so threads are enough. The first failure
+    is surfaced as SystemExit after all workers settle.
+
+    The pool follows the CPU affinity mask (default_jobs), is capped at 8
+    (protoc scales poorly past that), and PROTOC_JOBS overrides both.
+    """
+    if not cmds:
+        return
+    env_jobs = int(os.environ.get("PROTOC_JOBS", "0"))
+    if env_jobs:
+        # an explicit override is taken at face value, cap included
+        max_workers = min(env_jobs, len(cmds))
+    else:
+        max_workers = min(jobs or default_jobs(), 8, len(cmds))
+    first_err = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = [ex.submit(run_protoc, cmd) for cmd in cmds]
+        for f in concurrent.futures.as_completed(futs):
+            try:
+                f.result()
+            except SystemExit as e:
+                if first_err is None:
+                    first_err = e
+    if first_err is not None:
+        raise first_err
+
+
+def run_protoc_capture_fds(cmd) -> bytes:
+    """Run protoc with --descriptor_set_out pointed at /dev/stdout and return
+    the raw FileDescriptorSet bytes, skipping the disk round-trip."""
+    _echo_cmd(cmd)
     try:
-        r = subprocess.run(cmd, check=True, text=True, capture_output=True)
-        if r.stderr:
-            print(r.stderr, file=sys.stderr, end="")
+        # only stdout (the descriptor bytes) is captured; stderr streams.
+        # close_fds=False: same spawn fast path as run_protoc
+        r = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, close_fds=False)
     except subprocess.CalledProcessError as e:
-        if e.stderr:
-            print(e.stderr, file=sys.stderr)
         raise SystemExit(e.returncode)
+    return r.stdout
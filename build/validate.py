@@ -1,4 +1,5 @@
 from pathlib import Path
+import stat
 import sys
 
 
@@ -20,8 +21,13 @@ def validate_includes(includes):
     includes = dedup_keep_order(includes or [])
     bad = []
     for inc in includes:
-        p = Path(inc)
-        if not p.exists() or not p.is_dir():
+        # single stat per path; these run before every protoc spawn
+        try:
+            st = Path(inc).stat()
+        except OSError:
+            bad.append(inc)
+            continue
+        if not stat.S_ISDIR(st.st_mode):
             bad.append(inc)
     if bad:
         _die("-I/--include must be existing directories:\n  - " + "\n  - ".join(bad))
@@ -32,9 +38,12 @@ def validate_proto_files(proto_files):
     bad = []
     out = []
     for p in proto_files:
-        if not p.exists():
+        try:
+            st = p.stat()
+        except OSError:
             bad.append(f"{p} (not found)")
-        elif not p.is_file():
+            continue
+        if not stat.S_ISREG(st.st_mode):
             bad.append(f"{p} (not a file; did you mean -I?)")
         elif p.suffix != ".proto":
             bad.append(f"{p} (not .proto)")